@@ -21,14 +21,42 @@ import torch
 from torch import nn
 import torch.distributed as dist
 import torch.backends.cudnn as cudnn
+import torchvision
 from torchvision import datasets
 from torchvision import transforms as pth_transforms
 from torchvision import models as torchvision_models
-from torch.utils.data import Subset
 
 import utils
 import vision_transformer as vits
 
+DATASET_CONFIG = {
+    "ImageNet": dict(
+        train_crop_size=224,
+        val_crop_size=256,
+        mean=[0.485, 0.456, 0.406],
+        std=[0.229, 0.224, 0.225],
+    ),
+    "CIFAR-10": dict(
+        train_crop_size=32,
+        val_crop_size=int(32 * 8 / 7),  # TODO: check out!
+        mean=[0.4914, 0.4822, 0.4465],
+        std=[0.2023, 0.1994, 0.2010],
+    ),
+    "CIFAR-100": dict(
+        train_crop_size=32,
+        val_crop_size=int(32 * 8 / 7),  # TODO: check out!
+        mean=[0.5071, 0.4865, 0.4409],
+        std=[0.2673, 0.2564, 0.2762],
+    ),
+}
+
+# arguments the features cached with `cache_features` depend on
+CACHE_SETTINGS = ["arch", "patch_size", "pretrained_weights", "checkpoint_key", "n_last_blocks",
+                  "avgpool_patchtokens", "use_fp16", "dataset", "data_path", "is_neps_run", "seed"]
+
+# `torch.inference_mode` only exists from PyTorch 1.9 on, older versions fall back to `no_grad`
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
 
 def eval_linear(args):
     utils.fix_random_seeds(args.seed)
@@ -65,83 +93,86 @@ def eval_linear(args):
 
     linear_classifier = LinearClassifier(embed_dim, num_labels=args.num_labels)
     linear_classifier = linear_classifier.cuda()
-    linear_classifier = nn.parallel.DistributedDataParallel(linear_classifier, device_ids=[args.gpu])
+    # no DDP: the head is so small that its gradients are synchronized with a single all-reduce in `train`
+    # (or only its weights, every `val_freq` epochs, with `local_heads`).
+    # As DDP would, start all processes from the weights of the first one
+    for p in linear_classifier.parameters():
+        dist.broadcast(p.data, 0)
 
     # ============ preparing data ... ============
-    if args.dataset == "ImageNet":
-        train_crop_size = 224
-        val_crop_size = 256
-        normalize = pth_transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    elif args.dataset == "CIFAR-10":
-        train_crop_size = 32
-        val_crop_size = int(32 * 8 / 7)  # TODO: check out!
-        normalize = pth_transforms.Normalize(mean=[0.4914, 0.4822, 0.4465], std=[0.2023, 0.1994, 0.2010])
-    elif args.dataset == "CIFAR-100":
-        train_crop_size = 32
-        val_crop_size = int(32 * 8 / 7)  # TODO: check out!
-        normalize = pth_transforms.Normalize(mean=[0.5071, 0.4865, 0.4409], std=[0.2673, 0.2564, 0.2762])
-    else:
+    # accimage decodes JPEGs of ImageFolder datasets faster than PIL (Pillow-SIMD is a drop-in install instead)
+    torchvision.set_image_backend(args.image_backend)
+    if args.dataset not in DATASET_CONFIG:
         raise NotImplementedError(f"Dataset '{args.dataset}' not implemented yet!")
+    config = DATASET_CONFIG[args.dataset]
+    train_crop_size, val_crop_size = config["train_crop_size"], config["val_crop_size"]
+    mean, std = config["mean"], config["std"]
 
+    # images are loaded as uint8 tensors, the conversion to float and the normalization run on the gpu
     train_transform = pth_transforms.Compose([
         pth_transforms.RandomResizedCrop(train_crop_size),
         pth_transforms.RandomHorizontalFlip(),
-        pth_transforms.ToTensor(),
-        normalize,
+        pth_transforms.PILToTensor(),
     ])
 
     val_transform = pth_transforms.Compose([
         pth_transforms.Resize(val_crop_size, interpolation=3),
         pth_transforms.CenterCrop(train_crop_size),
-        pth_transforms.ToTensor(),
-        normalize,
+        pth_transforms.PILToTensor(),
     ])
 
-    dataset_train = utils.get_dataset(args=args, transform=train_transform, mode="train")
+    # the normalization statistics are known now, wrap the backbone
+    model = FeatureExtractor(model, args.arch, args.n_last_blocks, args.avgpool_patchtokens, mean, std, args.use_fp16).cuda()
+    # NHWC matches the tensor core layout of the convolutions (resnets, ViT patch embedding)
+    model = model.to(memory_format=torch.channels_last)
+    if args.compile_backbone:
+        # the wrapper is compiled rather than the backbone so that `get_intermediate_layers` is covered too
+        model = torch.compile(model, mode="reduce-overhead")
+
+    if args.cache_features:
+        # features are only computed once, so random augmentations would be frozen anyway
+        train_transform = val_transform
 
     if args.is_neps_run:
         if args.dataset == "ImageNet":
             # balanced valid dataset
-            # assumption: training dataset in `total_trainset` and you take care of doing the right thing with the transforms (as they are shared with `total_trainset`).
-            # It is easiest to load the training set twice with the right transforms and use one for training and one for validation.
-            dataset_train_trans = dataset_train
-            dataset_val_trans = utils.get_dataset(args=args, transform=val_transform, mode="train")
-            dataset_val = Subset(dataset_val_trans, args.valid_idx)
-            dataset_train = Subset(dataset_train_trans, args.train_idx)
+            # the training set is loaded only once, without transforms, and shared by both subsets which apply their own
+            # the stratified split is computed once during pre-training and handed over by `main_dino`
+            train_idx, valid_idx = args.assert_train_idx, args.assert_valid_idx
+            dataset_train_val = utils.get_dataset(args=args, transform=None, mode="train")
+            dataset_val = utils.TransformSubset(dataset_train_val, valid_idx, val_transform)
+            dataset_train = utils.TransformSubset(dataset_train_val, train_idx, train_transform)
 
             train_sampler = torch.utils.data.distributed.DistributedSampler(dataset_train)
             valid_sampler = torch.utils.data.distributed.DistributedSampler(dataset_val)
         else:
+            dataset_train = utils.get_dataset(args=args, transform=train_transform, mode="train")
             dataset_val = utils.get_dataset(args=args, transform=val_transform, mode="train")
             
             dataset_percentage_usage = 100
             valid_size = 0.1  # TODO: check out! For CIFAR-10 I would use 0.1. For balanced ImageNet 0.1 might also be fine?
             num_train = int(len(dataset_train) / 100 * dataset_percentage_usage)
-            indices = list(range(num_train))
-            split = int(np.floor(valid_size * num_train))
-            
-            np.random.shuffle(indices)
-    
-            if np.isclose(valid_size, 0.0):
-                train_idx, valid_idx = indices, indices
-            else:
-                train_idx, valid_idx = indices[split:], indices[:split]
+            train_idx, valid_idx = utils.random_split(num_train, valid_size, args.seed)
             
-            assert valid_idx[:10] == args.assert_valid_idx
+            assert np.array_equal(valid_idx[:10], args.assert_valid_idx[:10])
     
             train_sampler = torch.utils.data.distributed.DistributedSampler(train_idx)
             valid_sampler = torch.utils.data.distributed.DistributedSampler(valid_idx)
     
     else:
+        dataset_train = utils.get_dataset(args=args, transform=train_transform, mode="train")
         dataset_val = utils.get_dataset(args=args, transform=val_transform, mode="val")
         sampler = torch.utils.data.distributed.DistributedSampler(dataset_train)
     
+    # keep the workers alive across epochs and let them prefetch a few batches ahead
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
     train_loader = torch.utils.data.DataLoader(
         dataset_train,
         sampler=train_sampler if args.is_neps_run else sampler,
         batch_size=args.batch_size_per_gpu,
         num_workers=args.num_workers,
         pin_memory=True,
+        **worker_kwargs,
     )
     val_loader = torch.utils.data.DataLoader(
         dataset_val,
@@ -149,14 +180,28 @@ def eval_linear(args):
         batch_size=args.batch_size_per_gpu,
         num_workers=args.num_workers,
         pin_memory=True,
+        **worker_kwargs,
     )
 
     if args.evaluate:
         utils.load_pretrained_linear_weights(linear_classifier, args.arch, args.patch_size)
-        test_stats = validate_network(args, val_loader, model, linear_classifier, args.n_last_blocks, args.avgpool_patchtokens)
+        test_stats = validate_network(args, val_loader, model, linear_classifier)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
         return
-    
+
+    # the val transform is deterministic: the val features are extracted once and kept on the gpu,
+    # validating then only runs the linear classifier
+    val_features, val_labels = load_or_extract_features(args, model, val_loader, "val")
+    val_loader = list(zip(val_features.cuda().split(args.batch_size_per_gpu), val_labels.cuda().split(args.batch_size_per_gpu)))
+
+    if args.cache_features:
+        # the backbone is frozen: run it once and train the linear classifier on the stored features
+        train_features, train_labels = load_or_extract_features(args, model, train_loader, "train")
+        # the shard is already local, a single replica only keeps `set_epoch` reshuffling it
+        sampler = torch.utils.data.distributed.DistributedSampler(range(len(train_labels)), num_replicas=1, rank=0)
+        train_loader = CachedFeatureLoader(train_features, train_labels, args.batch_size_per_gpu, sampler)
+        model = None
+
     if args.is_neps_run:
         print(f"Data loaded with {len(train_idx)} train and {len(valid_idx)} val imgs.")
     else:
@@ -196,13 +241,20 @@ def eval_linear(args):
     for epoch in range(start_epoch, epoch_end_range):
         train_loader.sampler.set_epoch(epoch)
 
-        train_stats = train(args, model, linear_classifier, optimizer, train_loader, epoch, args.n_last_blocks, args.avgpool_patchtokens)
+        train_stats = train(args, model, linear_classifier, optimizer, train_loader, epoch)
         scheduler.step()
 
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                      'epoch': epoch}
-        if epoch % args.val_freq == 0 or epoch == args.epochs - 1:
-            test_stats = validate_network(args, val_loader, model, linear_classifier, args.n_last_blocks, args.avgpool_patchtokens)
+        do_validate = epoch % args.val_freq == 0 or epoch == args.epochs - 1
+        # with local heads, only the merged head is evaluated and checkpointed
+        do_save = not args.local_heads or do_validate or epoch == epoch_end_range - 1
+        if args.local_heads and do_save:
+            # merge the heads trained independently by each process, along with their SGD
+            # momentum buffers, so that every process continues from the same averaged state
+            utils.average_parameters(linear_classifier, optimizer)
+        if do_validate:
+            test_stats = validate_network(args, val_loader, None, linear_classifier)
             print(f"Accuracy at epoch {epoch} of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
             if args.do_early_stopping:
                 print("Do early stopping")
@@ -216,6 +268,7 @@ def eval_linear(args):
         if utils.is_main_process():
             with (Path(args.output_dir) / "log.txt").open("a") as f:
                 f.write(json.dumps(log_stats) + "\n")
+        if utils.is_main_process() and do_save:
             save_dict = {
                 "epoch": epoch + 1,
                 "state_dict": linear_classifier.state_dict(),
@@ -232,41 +285,42 @@ def eval_linear(args):
         with open(str(args.output_dir) + "/current_val_metric.txt", "w+") as f:
             f.write(f"{best_acc}\n")
 
-def train(args, model, linear_classifier, optimizer, loader, epoch, n, avgpool):
+def train(args, model, linear_classifier, optimizer, loader, epoch):
     linear_classifier.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
+    criterion = nn.CrossEntropyLoss()
     for (inp, target) in metric_logger.log_every(loader, 20, header):
         # move to gpu
         inp = inp.cuda(non_blocking=True)
         target = target.cuda(non_blocking=True)
 
         # forward
-        with torch.no_grad():
-            if "vit" in args.arch:
-                intermediate_output = model.get_intermediate_layers(inp, n)
-                output = torch.cat([x[:, 0] for x in intermediate_output], dim=-1)
-                if avgpool:
-                    output = torch.cat((output.unsqueeze(-1), torch.mean(intermediate_output[-1][:, 1:], dim=1).unsqueeze(-1)), dim=-1)
-                    output = output.reshape(output.shape[0], -1)
-            else:
+        if model is None:
+            # `inp` already holds the cached features
+            output = inp
+        else:
+            with inference_mode():
                 output = model(inp)
+            # inference tensors cannot be saved for the backward pass of the linear layer
+            output = output.clone()
         output = linear_classifier(output)
 
         # compute cross entropy loss
-        loss = nn.CrossEntropyLoss()(output, target)
+        loss = criterion(output, target)
 
         # compute the gradients
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
+        if not args.local_heads:
+            utils.all_reduce_gradients(linear_classifier)
 
         # step
         optimizer.step()
 
-        # log 
-        torch.cuda.synchronize()
-        metric_logger.update(loss=loss.item())
+        # log, the loss is only read back from the gpu when `log_every` prints
+        metric_logger.update_deferred(loss=loss)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -274,40 +328,34 @@ def train(args, model, linear_classifier, optimizer, loader, epoch, n, avgpool):
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
-@torch.no_grad()
-def validate_network(args, val_loader, model, linear_classifier, n, avgpool):
+@inference_mode()
+def validate_network(args, val_loader, model, linear_classifier):
     linear_classifier.eval()
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Test:'
+    criterion = nn.CrossEntropyLoss()
+    # top-5 accuracy only makes sense with at least 5 classes
+    has_top5 = linear_classifier.num_labels >= 5
+    topk = (1, 5) if has_top5 else (1,)
     for inp, target in metric_logger.log_every(val_loader, 20, header):
         # move to gpu
         inp = inp.cuda(non_blocking=True)
         target = target.cuda(non_blocking=True)
 
         # forward
-        with torch.no_grad():
-            if "vit" in args.arch:
-                intermediate_output = model.get_intermediate_layers(inp, n)
-                output = torch.cat([x[:, 0] for x in intermediate_output], dim=-1)
-                if avgpool:
-                    output = torch.cat((output.unsqueeze(-1), torch.mean(intermediate_output[-1][:, 1:], dim=1).unsqueeze(-1)), dim=-1)
-                    output = output.reshape(output.shape[0], -1)
-            else:
-                output = model(inp)
+        output = inp if model is None else model(inp)
         output = linear_classifier(output)
-        loss = nn.CrossEntropyLoss()(output, target)
+        loss = criterion(output, target)
 
-        if linear_classifier.module.num_labels >= 5:
-            acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
-        else:
-            acc1, = utils.accuracy(output, target, topk=(1,))
+        accs = utils.accuracy(output, target, topk=topk)
 
         batch_size = inp.shape[0]
-        metric_logger.update(loss=loss.item())
-        metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-        if linear_classifier.module.num_labels >= 5:
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
-    if linear_classifier.module.num_labels >= 5:
+        metric_logger.update_deferred(loss=loss)
+        metric_logger.update_deferred(n=batch_size, acc1=accs[0])
+        if has_top5:
+            metric_logger.update_deferred(n=batch_size, acc5=accs[1])
+    metric_logger.flush()
+    if has_top5:
         print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
           .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
     else:
@@ -316,6 +364,115 @@ def validate_network(args, val_loader, model, linear_classifier, n, avgpool):
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+@inference_mode()
+def extract_features(model, loader, dtype=torch.float32):
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    features, labels = [], []
+    for inp, target in metric_logger.log_every(loader, 20, 'Extract:'):
+        inp = inp.cuda(non_blocking=True)
+        features.append(model(inp).to(dtype).cpu())
+        labels.append(target)
+    return torch.cat(features), torch.cat(labels)
+
+
+def load_or_extract_features(args, model, loader, split):
+    """Features of the samples yielded by `loader`, cached on disk with `cache_features`"""
+    # every process caches the shard of the data its own sampler yields
+    cache_path = os.path.join(args.output_dir, f"{split}_features_rank{utils.get_rank()}.pth")
+    # everything the cached features depend on, a cache extracted with other settings is not reused
+    settings = {k: getattr(args, k, None) for k in CACHE_SETTINGS}
+    settings["world_size"] = utils.get_world_size()
+    # the weights file can be overwritten in place, e.g. when pretraining resumes into the same checkpoint
+    if os.path.isfile(args.pretrained_weights):
+        stat = os.stat(args.pretrained_weights)
+        settings["pretrained_weights_stat"] = (stat.st_mtime, stat.st_size)
+    if args.cache_features and os.path.isfile(cache_path):
+        cache = torch.load(cache_path, map_location="cpu")
+        if cache.get("settings") == settings:
+            print(f"Loading cached {split} features from {cache_path}")
+            return cache["features"], cache["labels"]
+        print(f"WARNING: the {split} features cached in {cache_path} were extracted with different settings "
+              f"({cache.get('settings')} instead of {settings}), extracting them again.")
+    print(f"Extracting {split} features...")
+    # cached features are stored in half precision, which is plenty for linear probing and halves
+    # memory and transfers, otherwise they are kept in fp32 like the ones the head is trained on
+    dtype = torch.float16 if args.cache_features else torch.float32
+    features, labels = extract_features(model, loader, dtype)
+    if args.cache_features:
+        torch.save({"features": features, "labels": labels, "settings": settings}, cache_path)
+    return features, labels
+
+
+class CachedFeatureLoader(object):
+    """
+    Batches of cached features, gathered into pinned host buffers that are allocated once
+    and reused, then copied asynchronously to the gpu.
+    """
+    def __init__(self, features, labels, batch_size, sampler):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.sampler = sampler
+        # two sets of buffers: one is filled while the copy out of the other one may still be running
+        self.buffers = [(
+            torch.empty((batch_size,) + features.shape[1:], dtype=features.dtype, pin_memory=True),
+            torch.empty(batch_size, dtype=labels.dtype, pin_memory=True),
+            torch.cuda.Event(),
+        ) for _ in range(2)]
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = torch.tensor(list(self.sampler))
+        for i, batch_indices in enumerate(indices.split(self.batch_size)):
+            features, labels, copied = self.buffers[i % 2]
+            # do not overwrite the buffers before their previous copy to the gpu is done
+            copied.synchronize()
+            features, labels = features[:len(batch_indices)], labels[:len(batch_indices)]
+            torch.index_select(self.features, 0, batch_indices, out=features)
+            torch.index_select(self.labels, 0, batch_indices, out=labels)
+            inp = features.cuda(non_blocking=True)
+            target = labels.cuda(non_blocking=True)
+            copied.record()
+            yield inp, target
+
+
+class FeatureExtractor(nn.Module):
+    """Frozen backbone returning the features the linear classifier is trained on"""
+    def __init__(self, backbone, arch, n, avgpool, mean, std, use_fp16=False):
+        super(FeatureExtractor, self).__init__()
+        self.backbone = backbone
+        self.is_vit = "vit" in arch
+        self.n = n
+        self.avgpool = avgpool
+        self.use_fp16 = use_fp16
+        self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        # uint8 images to normalized floats, done here on a whole batch instead of per sample in the workers
+        x = x.contiguous(memory_format=torch.channels_last).float().div_(255).sub_(self.mean).div_(self.std)
+        # no gradient flows through the backbone, so half precision is safe here
+        with torch.cuda.amp.autocast(self.use_fp16):
+            output = self._forward(x)
+        return output.float()
+
+    def _forward(self, x):
+        if not self.is_vit:
+            return self.backbone(x)
+        intermediate_output = self.backbone.get_intermediate_layers(x, self.n)
+        output = torch.cat([x[:, 0] for x in intermediate_output], dim=-1)
+        if self.avgpool:
+            # mean of the patch tokens, from a contiguous mean over all tokens minus the [CLS] contribution
+            last = intermediate_output[-1]
+            num_tokens = last.shape[1]
+            pooled = (num_tokens * last.mean(dim=1) - last[:, 0]) / (num_tokens - 1)
+            # interleave [CLS] and pooled features, the layout expected by the reference linear weights
+            output = torch.stack((output, pooled), dim=-1).flatten(1)
+        return output
+
+
 class LinearClassifier(nn.Module):
     """Linear layer to train on top of frozen features"""
     def __init__(self, dim, num_labels=1000):
@@ -329,8 +486,14 @@ class LinearClassifier(nn.Module):
         # flatten
         x = x.view(x.size(0), -1)
 
-        # linear layer
-        return self.linear(x)
+        # linear layer, kept in fp32 even when fed half precision cached features
+        return self.linear(x.float())
+
+    def load_state_dict(self, state_dict, strict=True):
+        # the reference weights and checkpoints saved while the head was wrapped in DDP carry a `module.`
+        # prefix, without stripping it a non-strict resume would silently load no weights at all
+        state_dict = {k.replace("module.", "", 1) if k.startswith("module.") else k: v for k, v in state_dict.items()}
+        return super(LinearClassifier, self).load_state_dict(state_dict, strict=strict)
 
 
 if __name__ == '__main__':
@@ -358,6 +521,18 @@ if __name__ == '__main__':
     parser.add_argument('--val_freq', default=1, type=int, help="Epoch frequency for validation.")
     parser.add_argument('--output_dir', default=".", help='Path to save logs and checkpoints')
     parser.add_argument('--num_labels', default=1000, type=int, help='Number of labels for linear classifier')
+    parser.add_argument('--use_fp16', type=utils.bool_flag, default=True, help="""Whether or not
+        to run the frozen backbone in half precision. Speeds up feature extraction and reduces memory.""")
+    parser.add_argument('--compile_backbone', default=False, type=utils.bool_flag, help="""Compile the
+        frozen backbone with `torch.compile` (requires PyTorch 2.0). Pays off for long runs without `cache_features`.""")
+    parser.add_argument('--image_backend', default='PIL', choices=['PIL', 'accimage'], help="""Backend
+        used by torchvision to load images. `accimage` needs to be installed separately.""")
+    parser.add_argument('--cache_features', default=False, type=utils.bool_flag, help="""Extract the
+        features of the frozen backbone once (without random augmentations), cache them in `output_dir`
+        and train the linear classifier on them instead of running the backbone at every epoch.""")
+    parser.add_argument('--local_heads', default=False, type=utils.bool_flag, help="""Train an independent
+        linear classifier on each GPU and only average their weights every `val_freq` epochs, instead of
+        all-reducing the gradients at every step.""")
     parser.add_argument('--evaluate', dest='evaluate', action='store_true', help='evaluate model on validation set')
     parser.add_argument("--is_neps_run", action="store_true", help="Set this flag to run a NEPS experiment.")
     parser.add_argument("--do_early_stopping", action="store_true", help="Set this flag to take the best test performance - Default by the DINO implementation.")
@@ -246,21 +246,16 @@ def train_dino(rank, working_directory, previous_working_directory, args, hyperp
     valid_size = 0.1
     dataset_percentage_usage = 100
     num_train = int(len(dataset) / 100 * dataset_percentage_usage)
-    indices = list(range(num_train))
-    split = int(np.floor(valid_size * num_train))
     
     if args.is_neps_run:
         if args.dataset == "ImageNet":
             if np.isclose(valid_size, 0.0):
-                train_idx, valid_idx = indices, indices
+                train_idx = valid_idx = list(range(num_train))
             else:
                 train_idx, valid_idx = utils.stratified_split(dataset.targets if hasattr(dataset, 'targets') else list(dataset.labels), valid_size)
         else:
-            np.random.shuffle(indices)
-            if np.isclose(valid_size, 0.0):
-                train_idx, valid_idx = indices, indices
-            else:
-                train_idx, valid_idx = indices[split:], indices[:split]
+            # eval_linear recomputes (and asserts) the very same split from the seed
+            train_idx, valid_idx = utils.random_split(num_train, valid_size, args.seed)
         
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_idx)
     
@@ -469,6 +464,18 @@ def train_dino(rank, working_directory, previous_working_directory, args, hyperp
             finetuning_parser.add_argument('--val_freq', default=1, type=int, help="Epoch frequency for validation.")
             finetuning_parser.add_argument('--output_dir', default=".", help='Path to save logs and checkpoints')
             finetuning_parser.add_argument('--num_labels', default=1000, type=int, help='Number of labels for linear classifier')
+            finetuning_parser.add_argument('--use_fp16', type=utils.bool_flag, default=True, help="""Whether or not
+            to run the frozen backbone in half precision. Speeds up feature extraction and reduces memory.""")
+            finetuning_parser.add_argument('--compile_backbone', default=False, type=utils.bool_flag, help="""Compile the
+            frozen backbone with `torch.compile` (requires PyTorch 2.0). Pays off for long runs without `cache_features`.""")
+            finetuning_parser.add_argument('--image_backend', default='PIL', choices=['PIL', 'accimage'], help="""Backend
+            used by torchvision to load images. `accimage` needs to be installed separately.""")
+            finetuning_parser.add_argument('--cache_features', default=False, type=utils.bool_flag, help="""Extract the
+            features of the frozen backbone once (without random augmentations), cache them in `output_dir`
+            and train the linear classifier on them instead of running the backbone at every epoch.""")
+            finetuning_parser.add_argument('--local_heads', default=False, type=utils.bool_flag, help="""Train an independent
+            linear classifier on each GPU and only average their weights every `val_freq` epochs, instead of
+            all-reducing the gradients at every step.""")
             finetuning_parser.add_argument('--evaluate', dest='evaluate', action='store_true', help='evaluate model on validation set')
             finetuning_parser.add_argument("--is_neps_run", action="store_true", help="Set this flag to run a NEPS experiment.")
             finetuning_parser.add_argument("--config_space", default="data_augmentation", choices=["data_augmentation", "training"], help="Select the configspace you want to optimize with NEPS")
@@ -95,6 +95,24 @@ def get_dataset(args, transform, mode, pretrain=False):
     return dataset
 
 
+class TransformSubset(torch.utils.data.Dataset):
+    """
+    Subset of a dataset loaded without transform, applying its own `transform`.
+    Lets differently transformed subsets share the same dataset (and list of samples).
+    """
+    def __init__(self, dataset, indices, transform):
+        self.dataset = dataset
+        self.indices = indices
+        self.transform = transform
+
+    def __getitem__(self, idx):
+        img, target = self.dataset[self.indices[idx]]
+        return self.transform(img), target
+
+    def __len__(self):
+        return len(self.indices)
+
+
 def load_pretrained_weights(model, pretrained_weights, checkpoint_key, model_name, patch_size):
     if os.path.isfile(pretrained_weights):
         state_dict = torch.load(pretrained_weights, map_location="cpu")
@@ -176,6 +194,42 @@ def cancel_gradients_last_layer(epoch, model, freeze_last_layer):
             p.grad = None
 
 
+def _all_reduce_mean_(tensors):
+    """
+    Average `tensors` in-place over all processes with a single all-reduce.
+    """
+    world_size = get_world_size()
+    if world_size < 2:
+        return
+    flat = torch._utils._flatten_dense_tensors(tensors)
+    dist.all_reduce(flat)
+    flat.div_(world_size)
+    for t, synced in zip(tensors, torch._utils._unflatten_dense_tensors(flat, tensors)):
+        t.copy_(synced)
+
+
+def all_reduce_gradients(model):
+    """
+    Average the gradients of `model` over all processes with a single all-reduce.
+    For small models this is cheaper than DDP, whose per-bucket all-reduces are latency bound.
+    """
+    _all_reduce_mean_([p.grad for p in model.parameters() if p.grad is not None])
+
+
+@torch.no_grad()
+def average_parameters(model, optimizer=None):
+    """
+    Average the weights of `model` over all processes, e.g. to merge models trained independently.
+    The momentum buffers `optimizer` keeps for them are averaged too, so that all processes resume
+    from the same state and the saved optimizer matches the saved weights.
+    """
+    tensors = [p for p in model.parameters()]
+    if optimizer is not None:
+        tensors += [optimizer.state[p]["momentum_buffer"] for p in model.parameters()
+                    if optimizer.state[p].get("momentum_buffer") is not None]
+    _all_reduce_mean_(tensors)
+
+
 def restart_from_checkpoint(ckp_path, run_variables=None, **kwargs):
     """
     Re-start from checkpoint
@@ -341,6 +395,7 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.deferred = {}
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
@@ -349,6 +404,36 @@ class MetricLogger(object):
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def update_deferred(self, n=1, **kwargs):
+        """
+        Like `update` for scalar tensors, but the values are only summed on their device. Reading
+        them synchronizes with the gpu, so it is postponed until they are printed or gathered.
+        """
+        for k, v in kwargs.items():
+            v = v.detach() * n
+            if k in self.deferred:
+                self.deferred[k][0] += v
+                self.deferred[k][1] += n
+            else:
+                self.deferred[k] = [v, n]
+
+    def flush(self):
+        """
+        Move the deferred values to their meters, with a single synchronization.
+        """
+        if not self.deferred:
+            return
+        names = list(self.deferred.keys())
+        totals = torch.stack([self.deferred[k][0] for k in names]).tolist()
+        for k, total in zip(names, totals):
+            count = self.deferred[k][1]
+            if k not in self.meters:
+                # each update is already the mean of a whole chunk, so the printed "median"
+                # is that of the last chunk rather than a window over many chunks
+                self.meters[k] = SmoothedValue(window_size=1)
+            self.meters[k].update(total / count, n=count)
+        self.deferred = {}
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -366,6 +451,7 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
+        self.flush()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -406,6 +492,7 @@ class MetricLogger(object):
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                self.flush()
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
@@ -558,6 +645,10 @@ def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     maxk = max(topk)
     batch_size = target.size(0)
+    if maxk == 1:
+        # a single argmax reduction, no need to sort the predictions
+        correct = output.argmax(1).eq(target).float().sum(0) * 100. / batch_size
+        return [correct for k in topk]
     _, pred = output.topk(maxk, 1, True, True)
     pred = pred.t()
     correct = pred.eq(target.reshape(1, -1).expand_as(pred))
@@ -891,6 +982,18 @@ def shufflelist_with_seed(lis, seed='2020'):
     random.setstate(s)
 
 
+def random_split(num_samples, val_share, seed):
+    """
+    Split `range(num_samples)` into shuffled train and validation indices.
+    Uses its own generator, so the split only depends on `seed` and not on the global numpy state.
+    """
+    indices = np.random.default_rng(seed).permutation(num_samples)
+    if np.isclose(val_share, 0.0):
+        return indices, indices
+    split = int(np.floor(val_share * num_samples))
+    return indices[split:], indices[:split]
+
+
 def stratified_split(labels, val_share):
     if isinstance(labels, torch.Tensor):
         labels = labels.tolist()